@@ -1,12 +1,27 @@
 import os
-import json
+import re
 import time
+import queue
+import atexit
+import itertools
+import collections
+import signal
+import asyncio
+import hmac
+import hashlib
 import logging
 import threading
-from datetime import datetime
-from typing import Dict, Any
-
-from flask import Flask, jsonify, render_template_string, request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, Iterator, List, Optional
+
+try:
+    import orjson
+except ImportError:  # sin la rueda de orjson: stdlib json, mismo formato pero más lento
+    orjson = None
+    import json
+from flask import Flask, Response, request, send_from_directory
+from hypercorn.asyncio import serve
+from hypercorn.config import Config as HypercornConfig
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import (
@@ -21,6 +36,8 @@ from telegram.ext import (
 # =========================
 # LOGGING
 # =========================
+# Convención: siempre logger.x("... %s", valor), nunca f-strings. Con %-args el
+# mensaje solo se formatea si el nivel está activo.
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
@@ -33,8 +50,17 @@ logger = logging.getLogger("sensutv-uploader")
 # =========================
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")  # obligatorio
 PORT = int(os.getenv("PORT", "10000"))
+WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))
 BOT_PAY_LINK = os.getenv("BOT_PAY_LINK", "").strip()
 
+# URL pública para el webhook de Telegram (Render define RENDER_EXTERNAL_URL).
+# Si queda vacía, el bot usa polling (útil en local).
+PUBLIC_URL = (os.getenv("PUBLIC_URL") or os.getenv("RENDER_EXTERNAL_URL") or "").strip().rstrip("/")
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or (
+    hashlib.sha256(TELEGRAM_TOKEN.encode("utf-8")).hexdigest() if TELEGRAM_TOKEN else ""
+)
+
 WASABI_BUCKET = os.getenv("WASABI_BUCKET", "sensutv-media")
 WASABI_REGION = os.getenv("WASABI_REGION", "eu-central-2")
 
@@ -56,119 +82,255 @@ def ensure_data_dir(preferred: str) -> str:
 
 DATA_DIR = ensure_data_dir(DATA_DIR)
 MODELS_FILE = os.path.join(DATA_DIR, "models.json")
-UPLOADS_FILE = os.path.join(DATA_DIR, "uploads.json")
+UPLOADS_FILE = os.path.join(DATA_DIR, "uploads.jsonl")
+LEGACY_UPLOADS_FILE = os.path.join(DATA_DIR, "uploads.json")
 
 # =========================
 # HELPERS JSON
 # =========================
+if orjson is not None:
+    def json_dumps(data: Any) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    json_loads = orjson.loads
+else:
+    def json_dumps(data: Any) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    json_loads = json.loads
+
+# path -> ((mtime_ns, size), obj). Solo se vuelve a parsear si el archivo cambió en disco.
+_cache: Dict[str, Any] = {}
+# serializa escrituras (comparten el .tmp); las lecturas no lo necesitan porque
+# os.replace es atómico y nadie ve un archivo a medio escribir
+_json_lock = threading.Lock()
+
+def _stat_key(path: str):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
 def _load_json(path: str, default: Any):
     try:
-        if not os.path.exists(path):
+        try:
+            key = _stat_key(path)
+        except FileNotFoundError:
             return default
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        hit = _cache.get(path)
+        if hit is not None and hit[0] == key:
+            return hit[1]
+        with open(path, "rb") as f:
+            data = json_loads(f.read())
+        _cache[path] = (key, data)
+        return data
     except Exception as e:
         logger.exception("Error leyendo %s: %s", path, e)
         return default
 
 def _save_json(path: str, data: Any):
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, path)
+    raw = json_dumps(data)  # compacto: solo lo lee la app
+    with _json_lock:
+        # siempre tmp + os.replace, también en /tmp/data: si la escritura falla a
+        # medias (p. ej. ENOSPC en tmpfs) el archivo anterior queda intacto
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        os.replace(tmp, path)
+        # el que escribe deja el cache listo: la próxima lectura no toca el JSON
+        _cache[path] = (_stat_key(path), data)
 
 def load_models() -> Dict[str, Any]:
+    # objeto compartido con el cache: solo lectura, los que escriben arman uno nuevo
     return _load_json(MODELS_FILE, {})
 
 def save_models(models: Dict[str, Any]):
     _save_json(MODELS_FILE, models)
 
+# serializa leer+fusionar+guardar: add_model corre en hilos del executor
+_models_write_lock = threading.Lock()
+
+def add_model(model_id: str, record: Dict[str, Any]):
+    """Agrega/reemplaza una modelo y guarda models.json (bloqueante: llamar fuera del loop)."""
+    with _models_write_lock:
+        # dict nuevo: load_models() devuelve el objeto del cache y no se debe mutar
+        # (si save_models falla, memoria y disco quedarían distintos)
+        save_models({**load_models(), model_id: record})
+
+# ---- uploads: log append-only (una línea JSON por registro) ----
+# El deque _uploads es el modelo de lectura: se carga una vez al arrancar y los
+# lectores nunca tocan disco. append_upload() lo actualiza al instante y encola
+# el registro; un hilo escritor lo agrega al archivo en lotes, juntando lo que
+# llegue durante _FLUSH_DELAY.
+_FLUSH_DELAY = 0.1
+
+_uploads: "collections.deque[Dict[str, Any]]" = collections.deque()
+_uploads_lock = threading.Lock()
+_upload_q: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+
+def append_upload(item: Dict[str, Any]):
+    with _uploads_lock:
+        _uploads.append(item)
+    _upload_q.put(item)
+
+_RETRY_MAX_DELAY = 60
+
+def _write_uploads(batch: List[Dict[str, Any]]):
+    data = memoryview(b"".join(json_dumps(it) + b"\n" for it in batch))
+    start = None  # tamaño del archivo antes del primer intento
+    delay = 1
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            # sin buffer: lo que falle a medias ya está en el archivo y se puede recortar
+            with open(UPLOADS_FILE, "ab", buffering=0) as f:
+                end = f.seek(0, os.SEEK_END)
+                if start is None:
+                    start = end
+                elif end != start:
+                    f.truncate(start)  # quita el fragmento del intento fallido
+                    f.seek(start)
+                view = data
+                while view:
+                    view = view[f.write(view):]
+            if attempt > 1:
+                logger.info("Escritura de %s recuperada tras %s intentos", UPLOADS_FILE, attempt)
+            return
+        except OSError as e:
+            if attempt == 1:
+                logger.exception("Error escribiendo %s (%s registros), reintento: %s", UPLOADS_FILE, len(batch), e)
+            else:
+                logger.warning("Sigue fallando la escritura de %s (intento %s): %s", UPLOADS_FILE, attempt, e)
+            time.sleep(delay)
+            delay = min(delay * 2, _RETRY_MAX_DELAY)
+
+def _upload_writer():
+    while True:
+        item = _upload_q.get()
+        if item is None:
+            return
+        time.sleep(_FLUSH_DELAY)
+        batch = [item]
+        stop = False
+        while True:
+            try:
+                nxt = _upload_q.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is None:
+                stop = True
+                break
+            batch.append(nxt)
+        _write_uploads(batch)
+        if stop:
+            return
+
+_writer_thread = threading.Thread(target=_upload_writer, name="uploads-writer", daemon=True)
+_writer_thread.start()
+
+@atexit.register
+def flush_uploads():
+    """Vacía la cola pendiente antes de salir."""
+    _upload_q.put(None)
+    _writer_thread.join(timeout=5)
+
+def _iter_uploads_file() -> Iterator[Dict[str, Any]]:
+    try:
+        f = open(UPLOADS_FILE, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json_loads(line)
+            except ValueError:
+                logger.warning("Línea inválida en %s, se ignora", UPLOADS_FILE)
+
 def load_uploads() -> Dict[str, Any]:
-    return _load_json(UPLOADS_FILE, {"items": []})
+    with _uploads_lock:
+        return {"items": list(_uploads)}
 
-def save_uploads(data: Dict[str, Any]):
-    _save_json(UPLOADS_FILE, data)
+def last_uploads(n: int) -> List[Dict[str, Any]]:
+    """Últimos n registros, el más nuevo primero."""
+    with _uploads_lock:
+        return list(itertools.islice(reversed(_uploads), n))
+
+def migrate_legacy_uploads():
+    """Pasa el uploads.json antiguo ({"items": [...]}) al log JSONL, una sola vez."""
+    if not os.path.exists(LEGACY_UPLOADS_FILE) or os.path.exists(UPLOADS_FILE):
+        return
+    # lectura directa, sin _load_json: el historial no debe quedarse en _cache
+    with open(LEGACY_UPLOADS_FILE, "rb") as f:
+        items = json_loads(f.read()).get("items", [])
+    tmp = UPLOADS_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        for it in items:
+            f.write(json_dumps(it) + b"\n")
+    os.replace(tmp, UPLOADS_FILE)
+    os.replace(LEGACY_UPLOADS_FILE, LEGACY_UPLOADS_FILE + ".migrated")
+    logger.info("Migrados %s registros de %s a %s", len(items), LEGACY_UPLOADS_FILE, UPLOADS_FILE)
+
+migrate_legacy_uploads()
+_uploads.extend(_iter_uploads_file())
+# generación de este proceso: el conteo solo es único dentro de un mismo log
+# (/tmp/data se borra en cada reinicio y el archivo puede truncarse o rotarse)
+_UPLOADS_GEN = time.time_ns()
+
+def models_etag() -> str:
+    try:
+        mtime_ns, size = _stat_key(MODELS_FILE)
+    except FileNotFoundError:
+        return "0"
+    return f"{mtime_ns:x}-{size:x}"
+
+def uploads_etag() -> str:
+    # dentro de un proceso el log solo crece: generación + nº de registros
+    # identifican su contenido
+    return f"{_UPLOADS_GEN:x}-{len(_uploads):x}"
+
+_SLUG_SEPARATORS = str.maketrans({c: "-" for c in " ./\\|:;,+&"})
+_SLUG_DROP = re.compile(r"[^\w-]+")  # \w = alfanumérico (unicode) o "_"
+_SLUG_DASHES = re.compile(r"-{2,}")
+_NON_DIGITS = re.compile(r"\D+")
 
 def slugify(s: str) -> str:
-    s = s.strip().lower()
-    out = []
-    for ch in s:
-        if ch.isalnum():
-            out.append(ch)
-        elif ch in [" ", ".", "/", "\\", "|", ":", ";", ",", "+", "&"]:
-            out.append("-")
-        elif ch in ["_", "-"]:
-            out.append(ch)
-    res = "".join(out)
-    while "--" in res:
-        res = res.replace("--", "-")
-    return res.strip("-")
-
-def now_yyyymmdd() -> str:
-    return datetime.utcnow().strftime("%Y-%m-%d")
+    s = s.strip().lower().translate(_SLUG_SEPARATORS)
+    s = _SLUG_DROP.sub("", s)
+    return _SLUG_DASHES.sub("-", s).strip("-")
+
+_today = (0, "")  # (segundo epoch, "YYYY-MM-DD"), se reemplaza como tupla entera
+
+# Ambos aceptan un `ts` ya leído para que un handler consulte el reloj una sola vez.
+def now_yyyymmdd(ts: Optional[float] = None) -> str:
+    global _today
+    sec = int(time.time() if ts is None else ts)
+    if _today[0] != sec:
+        _today = (sec, time.strftime("%Y-%m-%d", time.gmtime(sec)))
+    return _today[1]
+
+def now_iso(ts: Optional[float] = None) -> str:
+    # ISO-8601 UTC sin pasar por datetime (utcnow() está deprecado en 3.12)
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
 
 # =========================
 # FLASK WEB (mini landing)
 # =========================
 app = Flask(__name__)
 
-HOME_HTML = """<!doctype html><html><head>
-<meta charset="utf-8"/>
-<title>SensuTV</title>
-<meta name="viewport" content="width=device-width, initial-scale=1"/>
-<style>
-  body{font-family:system-ui,Arial;margin:0;background:#0b0b10;color:#fff}
-  .wrap{max-width:900px;margin:0 auto;padding:24px}
-  .card{background:#141421;border:1px solid #2a2a3a;border-radius:16px;padding:18px;margin:14px 0}
-  .btn{display:inline-block;padding:12px 16px;border-radius:14px;text-decoration:none;margin-right:10px;font-weight:700}
-  .btn1{background:#6d28d9;color:#fff}
-  .btn2{background:#ff3d8a;color:#fff}
-  .muted{color:#b9b9c9}
-  .grid{display:grid;grid-template-columns:repeat(auto-fit,minmax(240px,1fr));gap:12px}
-  .pill{display:inline-block;padding:4px 10px;border-radius:999px;border:1px solid #2a2a3a;color:#cfcfe6;font-size:12px}
-  .mono{font-family:ui-monospace,Menlo,Consolas,monospace;font-size:12px;color:#cfcfe6;word-break:break-all}
-</style></head><body>
-<div class="wrap">
-  <h2>SensuTV</h2>
-  <div class="muted">Webapp en Render + bot en Telegram + media en Wasabi.</div>
-
-  <div class="card">
-    <h3>Entra... y mira lo que otros no ven 🔥</h3>
-    <div class="muted">Previews gratis. Si quieres lo completo... desbloquea Premium.</div>
-    <div style="margin-top:14px">
-      <a class="btn btn1" href="/feed?tier=free">Ver previews gratis</a>
-      <a class="btn btn2" href="/premium">Desbloquear Premium</a>
-    </div>
-    {% if bot_pay_link %}
-      <div style="margin-top:12px" class="muted">
-        Link bot: <span class="mono">{{bot_pay_link}}</span>
-      </div>
-    {% endif %}
-  </div>
-
-  <div class="card">
-    <h3>Últimas subidas (registro)</h3>
-    <div class="muted">Se alimenta de <span class="mono">uploads.json</span> (lo crea el bot con /plan).</div>
-    <div class="grid" style="margin-top:12px">
-      {% for it in items %}
-      <div class="card" style="margin:0">
-        <div class="pill">{{it.get("model_name","")}} • {{it.get("country","")}}</div>
-        <div style="margin-top:10px"><b>{{it.get("title","Nuevo contenido")}}</b></div>
-        <div class="muted" style="margin-top:6px">{{it.get("type","")}} • {{it.get("date","")}}</div>
-        <div class="mono" style="margin-top:10px">wasabi://{{it.get("bucket","")}}/{{it.get("path","")}}</div>
-      </div>
-      {% endfor %}
-    </div>
-  </div>
-
-  <div class="card">
-    <h3>Estado</h3>
-    <div class="muted">Bucket: <b>{{bucket}}</b> • Region: <b>{{region}}</b></div>
-    <div class="muted">DATA_DIR: <span class="mono">{{data_dir}}</span></div>
-    <div class="muted">API: <a style="color:#bfa7ff" href="/api/models">/api/models</a> • <a style="color:#bfa7ff" href="/api/uploads">/api/uploads</a></div>
-  </div>
-</div></body></html>
-"""
+def json_response(data: Any, status: int = 200) -> Response:
+    # bytes ya serializados, sin jsonify (evita sort_keys y el encoder de Flask)
+    return Response(json_dumps(data), status=status, mimetype="application/json")
+
+def etag_json_response(etag: str, build: Callable[[], Any]) -> Response:
+    # Si el cliente ya tiene esta versión: 304 sin cuerpo y sin serializar nada.
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = json_response(build())
+    resp.set_etag(etag, weak=True)
+    resp.cache_control.max_age = 5
+    return resp
 
 @app.get("/healthz")
 def healthz():
@@ -176,46 +338,86 @@ def healthz():
 
 @app.get("/")
 def home():
-    uploads = load_uploads().get("items", [])
-    items = list(reversed(uploads))[:6]
-    return render_template_string(
-        HOME_HTML,
-        items=items,
-        bot_pay_link=BOT_PAY_LINK,
-        bucket=WASABI_BUCKET,
-        region=WASABI_REGION,
-        data_dir=DATA_DIR,
-    )
+    # HTML estático cacheable (max_age=60); las tarjetas se cargan desde /feed en el navegador
+    return send_from_directory(app.static_folder, "index.html", max_age=60)
+
+@app.get("/api/status")
+def api_status():
+    return json_response({
+        "bucket": WASABI_BUCKET,
+        "region": WASABI_REGION,
+        "data_dir": DATA_DIR,
+        "bot_pay_link": BOT_PAY_LINK,
+    })
 
 @app.get("/api/models")
 def api_models():
-    return jsonify(load_models())
+    return etag_json_response(models_etag(), load_models)
 
 @app.get("/api/uploads")
 def api_uploads():
-    return jsonify(load_uploads())
+    return etag_json_response(uploads_etag(), load_uploads)
 
 @app.get("/feed")
 def feed():
     tier = request.args.get("tier", "free")
-    data = load_uploads().get("items", [])
-    return jsonify({"tier": tier, "items": list(reversed(data))})
+    limit = request.args.get("limit", type=int)
+    if limit and limit > 0:
+        items = last_uploads(limit)
+    else:
+        items = load_uploads()["items"]
+        items.reverse()  # la lista es nueva en cada llamada: se invierte in-place, sin copia
+    return json_response({"tier": tier, "items": items})
 
 @app.get("/premium")
 def premium():
     if BOT_PAY_LINK:
-        return jsonify({"ok": True, "next": BOT_PAY_LINK})
-    return jsonify({"ok": False, "error": "BOT_PAY_LINK not set"}), 400
-
-def run_flask():
-    logger.info("Starting Flask on port %s", PORT)
-    app.run(host="0.0.0.0", port=PORT, debug=False)
+        return json_response({"ok": True, "next": BOT_PAY_LINK})
+    return json_response({"ok": False, "error": "BOT_PAY_LINK not set"}, 400)
+
+# ---- webhook de Telegram ----
+# run_bot() los rellena cuando el bot arranca en modo webhook
+_bot_app: Optional[Application] = None
+_bot_loop: Optional[asyncio.AbstractEventLoop] = None
+
+@app.post(WEBHOOK_PATH)
+def telegram_webhook():
+    if _bot_app is None or _bot_loop is None:
+        return "", 503
+    # comparación en tiempo constante (bytes: compare_digest no acepta str no ASCII)
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8")):
+        return "", 403
+    try:
+        data = json_loads(request.get_data())
+    except ValueError:
+        return "", 400
+    if not isinstance(data, dict) or not data:
+        return "", 400
+    update = Update.de_json(data, _bot_app.bot)
+    # se encola en el loop del bot; el handler corre allí, no en este hilo
+    asyncio.run_coroutine_threadsafe(_bot_app.update_queue.put(update), _bot_loop)
+    return "", 200
+
+async def run_web(stop: asyncio.Event):
+    # Hypercorn sirve Flask desde el mismo loop que el bot: los sockets HTTP los
+    # atiende asyncio y solo la vista WSGI pasa al executor por defecto del loop.
+    config = HypercornConfig()
+    config.bind = [f"0.0.0.0:{PORT}"]
+    # sin el handler propio de Hypercorn (errorlog="-"): sus líneas salen una sola
+    # vez, por el handler raíz de basicConfig y con el mismo formato
+    config.errorlog = logging.getLogger("hypercorn.error")
+    logger.info("Starting Flask (hypercorn, %s threads) on port %s", WEB_THREADS, PORT)
+    await serve(app, config, shutdown_trigger=stop.wait, mode="wsgi")
 
 # =========================
 # TELEGRAM BOT (PTB v20.x)
 # =========================
 S_MODEL_NAME, S_COUNTRY, S_AGE, S_TAGS, S_TYPE, S_CATEGORY = range(6)
 
+# campos fijos de cada registro de /plan
+_UPLOAD_BASE = {"bucket": WASABI_BUCKET, "region": WASABI_REGION}
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (
         "✅ *SensuTV Bot activo*\n\n"
@@ -241,11 +443,10 @@ async def cmd_models(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
 
 async def cmd_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uploads = load_uploads().get("items", [])
-    if not uploads:
+    last = last_uploads(10)
+    if not last:
         await update.message.reply_text("No hay registros aún. Usa /plan para generar rutas.")
         return
-    last = list(reversed(uploads))[:10]
     lines = ["🕒 *Últimas rutas generadas:*"]
     for it in last:
         lines.append(f"• {it.get('date','')} — *{it.get('model_name','')}* — `{it.get('path','')}`")
@@ -268,7 +469,7 @@ async def register_country(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def register_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text.strip()
-    age = "".join([c for c in txt if c.isdigit()])
+    age = _NON_DIGITS.sub("", txt)
     context.user_data["age"] = age if age else "?"
     await update.message.reply_text("Tags separadas por coma (ej: latina, milf, cosplay):")
     return S_TAGS
@@ -279,18 +480,21 @@ async def register_tags(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = context.user_data.get("model_name", "").strip()
     country = context.user_data.get("country", "").strip()
     age = context.user_data.get("age", "?")
-    model_id = slugify(name) or f"model-{int(time.time())}"
+    now = time.time()
+    model_id = slugify(name) or f"model-{int(now)}"
 
-    models = load_models()
-    models[model_id] = {
+    record = {
         "id": model_id,
         "name": name,
         "country": country,
+        "country_slug": slugify(country) or "unknown",  # prefijo de las rutas de /plan
         "age": age,
         "tags": tags,
-        "created_at": datetime.utcnow().isoformat() + "Z",
+        "created_at": now_iso(now),
     }
-    save_models(models)
+    # escritura + os.replace fuera del event loop
+    await asyncio.to_thread(add_model, model_id, record)
+    logger.info("Modelo registrada: %s (%s)", model_id, country)
 
     await update.message.reply_text(
         f"✅ Registrada: *{name}*\nID: `{model_id}`\nPaís: {country}\nEdad: {age}\nTags: {', '.join(tags) if tags else '-'}",
@@ -300,12 +504,19 @@ async def register_tags(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # ---- PLAN FLOW ----
+_PLAN_KEYS = ("plan_models", "plan_model_id", "plan_model", "plan_type")
+
 async def plan_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # un /plan abandonado no deja su snapshot vivo hasta el próximo clear()
+    for k in _PLAN_KEYS:
+        context.user_data.pop(k, None)
     models = load_models()
     if not models:
         await update.message.reply_text("Primero registra una modelo con /register")
         return ConversationHandler.END
 
+    # snapshot para los siguientes pasos del flujo: no se vuelve a leer models.json
+    context.user_data["plan_models"] = models
     lines = ["Elige modelo (escribe el *ID*):"]
     for k, v in models.items():
         lines.append(f"• `{k}` = {v.get('name','')} ({v.get('country','')})")
@@ -314,11 +525,16 @@ async def plan_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def plan_pick_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
     model_id = slugify(update.message.text.strip())
-    models = load_models()
+    models = context.user_data.get("plan_models") or {}
+    if model_id not in models:
+        # puede haberse registrado después de /plan: con el cache al día es un stat()
+        models = load_models()
     if model_id not in models:
         await update.message.reply_text("❌ ID no válido. Copia/pega el ID exacto de la lista.")
         return S_MODEL_NAME
+    context.user_data.pop("plan_models", None)
     context.user_data["plan_model_id"] = model_id
+    context.user_data["plan_model"] = models[model_id]
     await update.message.reply_text("Tipo de archivo: escribe `video` o `foto`")
     return S_TYPE
 
@@ -335,17 +551,16 @@ async def plan_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cat = slugify(update.message.text.strip()) or "general"
     model_id = context.user_data["plan_model_id"]
     t = context.user_data["plan_type"]
-    models = load_models()
-    m = models[model_id]
-    date = now_yyyymmdd()
+    m = context.user_data["plan_model"]
+    now = time.time()
+    date = now_yyyymmdd(now)
 
-    country = slugify(m.get("country", "unknown")) or "unknown"
+    # modelos registradas antes de guardar country_slug lo calculan aquí
+    country = m.get("country_slug") or slugify(m.get("country", "unknown")) or "unknown"
     path = f"{country}/{model_id}/{t}/{cat}/{date}/"
 
-    uploads = load_uploads()
-    uploads["items"].append({
-        "bucket": WASABI_BUCKET,
-        "region": WASABI_REGION,
+    append_upload({
+        **_UPLOAD_BASE,
         "model_id": model_id,
         "model_name": m.get("name", ""),
         "country": m.get("country", ""),
@@ -354,9 +569,9 @@ async def plan_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "date": date,
         "title": f"{m.get('name','')} • {t} • {cat}",
         "path": path,
-        "created_at": datetime.utcnow().isoformat() + "Z",
+        "created_at": now_iso(now),
     })
-    save_uploads(uploads)
+    logger.info("Ruta generada para %s: %s", model_id, path)
 
     msg = (
         "✅ *Ruta generada*\n\n"
@@ -378,16 +593,16 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Cancelado.")
     return ConversationHandler.END
 
-def main():
-    if not TELEGRAM_TOKEN:
-        raise RuntimeError("Falta TELEGRAM_TOKEN en Render (Environment).")
-
-    # Flask en thread separado
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-
-    # Telegram
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+def build_application() -> Application:
+    # HTTP/2: las respuestas se multiplexan sobre la conexión ya abierta con
+    # Telegram en vez de abrir (TCP+TLS) una nueva por cada petición concurrente
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .http_version("2")
+        .pool_timeout(30)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", cmd_start))
     application.add_handler(CommandHandler("models", cmd_models))
@@ -418,9 +633,48 @@ def main():
 
     application.add_handler(register_conv)
     application.add_handler(plan_conv)
+    return application
+
+async def run_bot(stop: asyncio.Event):
+    global _bot_app, _bot_loop
+    application = build_application()
+    loop = asyncio.get_running_loop()
+
+    async with application:
+        await application.start()
+        if PUBLIC_URL:
+            _bot_app, _bot_loop = application, loop
+            await application.bot.set_webhook(
+                url=PUBLIC_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=True,
+            )
+            logger.info("Telegram bot using webhook %s%s", PUBLIC_URL, WEBHOOK_PATH)
+        else:
+            logger.info("Telegram bot starting polling...")
+            await application.updater.start_polling(drop_pending_updates=True)
+
+        await stop.wait()
+
+        _bot_app = None
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+
+async def run():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=WEB_THREADS))
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # web (también recibe el webhook de Telegram) + bot en un solo loop
+    await asyncio.gather(run_web(stop), run_bot(stop))
 
-    logger.info("Telegram bot starting polling...")
-    application.run_polling(drop_pending_updates=True)
+def main():
+    if not TELEGRAM_TOKEN:
+        raise RuntimeError("Falta TELEGRAM_TOKEN en Render (Environment).")
+    asyncio.run(run())
 
 if __name__ == "__main__":
     main()